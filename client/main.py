@@ -2,12 +2,22 @@ import os
 import hashlib
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote
 import time
 import concurrent.futures
 import shutil
 import zipfile
+import tempfile
 import sys
+import threading
+import mmap
+import functools
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 # --- 客戶端設定檔 ---
 config_file = "client_config.txt"
@@ -15,10 +25,27 @@ folders = {}
 
 server_url = "http://localhost:8000"
 
+# 計算 MD5 的執行緒數，可用環境變數 MODSYNC_HASH_WORKERS 調整
+HASH_WORKERS = int(os.environ.get("MODSYNC_HASH_WORKERS", (os.cpu_count() or 1) * 5))
+
+# 向伺服器請求的校驗演算法；安裝 blake3 時使用 BLAKE3，否則沿用 MD5
+DIGEST_ALGO = "blake3" if blake3 else "md5"
+
+# 下載執行緒數；連線池大小與其一致，讓每個執行緒都能重用 keep-alive 連線
+MAX_WORKERS = 8
+
+# 需下載的檔案超過此數量時，改向伺服器一次索取只含這些檔案的 zip
+SMALL_BATCH_THRESHOLD = 32
+
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=3)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
 # 從伺服器獲取資料夾名稱列表
 try:
     print(f"正在連線伺服器以獲取設定檔: {server_url}/config_names?json=1")
-    resp = requests.get(f"{server_url}/config_names?json=1", timeout=10)
+    resp = session.get(f"{server_url}/config_names?json=1", timeout=10)
     if resp.status_code == 200:
         folder_names = resp.json()
     else:
@@ -53,27 +80,106 @@ for line in open(config_file, "r", encoding="utf-8"):
     folders[key] = {"path": path, "force": force}
 
 
-# --- MD5 ---
-def get_md5(file_path):
-    hash_md5 = hashlib.md5()
+# --- 校驗碼 ---
+# 舊版 Python 沒有 hashlib.file_digest 時，每個執行緒重複使用 1 MiB 緩衝區
+_read_local = threading.local()
+
+
+def _read_buffer():
+    buf = getattr(_read_local, "buf", None)
+    if buf is None:
+        buf = _read_local.buf = memoryview(bytearray(1 << 20))
+    return buf
+
+
+def _hash_file(file_path, algo):
+    with open(file_path, "rb") as f:
+        if algo == "blake3":
+            if os.fstat(f.fileno()).st_size == 0:
+                return blake3.blake3().hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return blake3.blake3(mm, max_threads=blake3.blake3.AUTO).hexdigest()
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, algo).hexdigest()
+        hasher = hashlib.new(algo)
+        buf = _read_buffer()
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(buf[:n])
+    return hasher.hexdigest()
+
+
+# 校驗碼快取：{完整路徑: (mtime_ns, size, {演算法: 校驗碼})}，本地檔案未變動時不必重新計算
+DIGEST_CACHE_FILE = ".digestcache.json"
+
+
+def load_digest_cache():
+    try:
+        with open(DIGEST_CACHE_FILE, "r", encoding="utf-8") as f:
+            return {path: tuple(v) for path, v in json.load(f).items()}
+    except Exception:
+        return {}
+
+
+def save_digest_cache():
     try:
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        with open(DIGEST_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(_digest_cache, f, ensure_ascii=False)
+    except Exception as e:
+        print(f"儲存校驗碼快取失敗: {e}")
+
+
+_digest_cache = load_digest_cache()
+
+
+def get_digest(file_path, algo="md5", st=None):
+    # file_path 也可以是 os.DirEntry；已取得 stat 時可直接傳入 st，省去一次 stat
+    try:
+        if isinstance(file_path, os.DirEntry):
+            st = file_path.stat()
+            file_path = file_path.path
+        elif st is None:
+            st = os.stat(file_path)
+        cached = _digest_cache.get(file_path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            digests = cached[2]
+            if algo in digests:
+                return digests[algo]
+        else:
+            digests = {}
+            _digest_cache[file_path] = (st.st_mtime_ns, st.st_size, digests)
+        digest = digests[algo] = _hash_file(file_path, algo)
+        return digest
     except:
         return None
 
 
 # --- 遞歸掃描 ---
-def scan_folder(folder_path):
-    files_md5 = {}
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            full_path = os.path.join(root, file)
-            rel_path = os.path.relpath(full_path, folder_path).replace("\\", "/")
-            files_md5[rel_path] = get_md5(full_path)
-    return files_md5
+def scan_folder(folder_path, algo="md5"):
+    entries = []
+    stack = [folder_path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    # 與 os.walk 相同，不進入符號連結的資料夾（避免 d/up -> .. 之類的迴圈）
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        entries.append(entry)
+        except OSError as e:
+            print(f"掃描資料夾失敗: {current}, {e}")
+    if not entries:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        digests = list(executor.map(lambda e: get_digest(e, algo), entries))
+    return {
+        os.path.relpath(entry.path, folder_path).replace("\\", "/"): digest
+        for entry, digest in zip(entries, digests)
+    }
 
 
 # --- 統計檔案數量 ---
@@ -87,30 +193,73 @@ def count_server_files(server_dict):
     return total
 
 
+# --- 平行解壓 ---
+def zip_target_path(info, extract_to):
+    """依 ZipFile.extract 的規則算出項目的解壓路徑（去除磁碟代號、空白段、. 與 ..）"""
+    arcname = info.filename.replace("/", os.sep)
+    if os.altsep:
+        arcname = arcname.replace(os.altsep, os.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.sep.join(p for p in arcname.split(os.sep) if p not in ("", os.curdir, os.pardir))
+    if os.sep == "\\":
+        arcname = zipfile.ZipFile._sanitize_windows_name(arcname, os.sep)
+    return os.path.join(extract_to, arcname)
+
+
+def extract_zip_parallel(zip_ref, extract_to):
+    """將檔案分派給多個執行緒解壓
+
+    不使用 ZipFile.extract()：它建立上層目錄時沒有 exist_ok，多個執行緒同時建立同一個目錄會
+    拋出 FileExistsError。這裡每個項目自行以 exist_ok=True 建立目錄再寫入；
+    同一個 ZipFile 讀取時本身有鎖保護。
+    """
+    def extract(info):
+        target = zip_target_path(info, extract_to)
+        if info.is_dir():
+            os.makedirs(target, exist_ok=True)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with zip_ref.open(info) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        list(executor.map(extract, zip_ref.infolist()))
+
+
 # --- 下載 ZIP 並解壓 ---
-def download_and_extract_zip(zip_url, extract_to):
-    zip_local = os.path.join(os.getcwd(), "temp.zip")
+def download_and_extract_zip(session, zip_url, extract_to, paths=None):
+    """下載 zip 並解壓，成功時回傳 True；指定 paths 時以 POST 索取只含這些檔案的 zip"""
     try:
         print(f"📦 下載 ZIP: {zip_url}")
-        r = requests.get(zip_url, stream=True, timeout=30)
-        with open(zip_local, "wb") as f:
-            for chunk in r.iter_content(65536):
+        if paths is None:
+            r = session.get(zip_url, stream=True, timeout=30)
+        else:
+            r = session.post(zip_url, json=paths, stream=True, timeout=30)
+        r.raise_for_status()
+        # zipfile 需要可 seek 的來源，先寫入暫存檔
+        # （不用 SpooledTemporaryFile：Python 3.10 以前它沒有 seekable()，zipfile 無法開啟）
+        with tempfile.TemporaryFile() as spool:
+            for chunk in r.iter_content(1 << 20):
                 if chunk:
-                    f.write(chunk)
-        print("🧩 下載完成，開始解壓縮 ...")
-        with zipfile.ZipFile(zip_local, 'r') as zip_ref:
-            zip_ref.extractall(extract_to)
+                    spool.write(chunk)
+            print("🧩 下載完成，開始解壓縮 ...")
+            spool.seek(0)
+            with zipfile.ZipFile(spool, 'r') as zip_ref:
+                extract_zip_parallel(zip_ref, extract_to)
         print("✅ 解壓完成。")
+        return True
     except Exception as e:
         print(f"❌ 下載或解壓失敗: {e}")
-    finally:
-        if os.path.exists(zip_local):
-            os.remove(zip_local)
+        return False
 
 
 # --- 單檔下載 ---
-def download_file(base_url, folder_key, file_path, save_dir, max_retries=3):
-    file_url = f"{base_url}/{folder_key}/{quote(file_path)}?download=1"
+# 同一路徑的 URL 編碼結果固定不變，快取起來避免重試或重複同步時重新計算
+_quote = functools.lru_cache(maxsize=1 << 16)(quote)
+
+
+def download_file(session, base_url, folder_key, file_path, save_dir, max_retries=3):
+    file_url = f"{base_url}/{folder_key}/{_quote(file_path)}?download=1"
     local_path = os.path.join(save_dir, file_path.replace("/", os.sep))
     os.makedirs(os.path.dirname(local_path), exist_ok=True)
     for attempt in range(max_retries):
@@ -120,11 +269,17 @@ def download_file(base_url, folder_key, file_path, save_dir, max_retries=3):
             if os.path.exists(local_path):
                 existing_size = os.path.getsize(local_path)
                 headers['Range'] = f'bytes={existing_size}-'
-            with requests.get(file_url, stream=True, headers=headers, timeout=15) as r:
+            with session.get(file_url, stream=True, headers=headers, timeout=15) as r:
+                if r.status_code == 416 and existing_size > 0:
+                    # 本地檔案已是完整大小，無需續傳
+                    print(f"[下載完成] {folder_key}/{file_path}")
+                    return True
                 if r.status_code in (200, 206):
-                    mode = 'ab' if existing_size > 0 else 'wb'
+                    # 只有伺服器回 206 時才接續寫入，回 200 表示傳回完整檔案
+                    mode = 'ab' if r.status_code == 206 else 'wb'
+                    # 以 1 MiB 為單位寫入，減少 Python 層的迴圈次數
                     with open(local_path, mode) as f:
-                        for chunk in r.iter_content(65536):
+                        for chunk in r.iter_content(1 << 20):
                             if chunk:
                                 f.write(chunk)
                     print(f"[下載完成] {folder_key}/{file_path}")
@@ -138,32 +293,105 @@ def download_file(base_url, folder_key, file_path, save_dir, max_retries=3):
 
 
 # --- 收集下載任務 ---
-def collect_download_tasks(server_dict, local_base, rel_path=""):
+def _flatten(server_dict, rel_path=""):
+    """將伺服器的嵌套結構攤平成 (目錄列表, 檔案路徑列表, 校驗碼列表)"""
+    dirs, paths, digests = [], [], []
+    stack = [(server_dict, rel_path)]
+    while stack:
+        node, prefix = stack.pop()
+        for name, value in node.items():
+            local_rel = f"{prefix}/{name}" if prefix else name
+            if isinstance(value, dict):
+                dirs.append(local_rel)
+                stack.append((value, local_rel))
+            else:
+                paths.append(local_rel)
+                digests.append(value)
+    return dirs, paths, digests
+
+
+def _try_stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def collect_download_tasks(server_dict, local_base, rel_path="", algo="md5"):
+    dirs, paths, expected = _flatten(server_dict, rel_path)
+    for local_rel in dirs:
+        os.makedirs(os.path.join(local_base, local_rel.replace("/", os.sep)), exist_ok=True)
+    abs_paths = [os.path.join(local_base, local_rel.replace("/", os.sep)) for local_rel in paths]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        # 1. 一次 stat 所有檔案，找出缺失的檔案
+        stats = list(executor.map(_try_stat, abs_paths))
+        # 2. 只對存在的檔案平行計算校驗碼
+        existing = [i for i, st in enumerate(stats) if st is not None]
+        local_digests = [None] * len(paths)
+        for i, digest in zip(existing, executor.map(lambda i: get_digest(abs_paths[i], algo, stats[i]), existing)):
+            local_digests[i] = digest
+
+    # 3. 比對結果
     tasks = []
-    for name, value in server_dict.items():
-        local_rel = f"{rel_path}/{name}" if rel_path else name
-        local_abs = os.path.join(local_base, local_rel.replace("/", os.sep))
-        if isinstance(value, dict):
-            os.makedirs(local_abs, exist_ok=True)
-            tasks.extend(collect_download_tasks(value, local_base, local_rel))
-        else:
-            local_md5 = get_md5(local_abs) if os.path.exists(local_abs) else None
-            if not local_md5 or local_md5 != value:
-                if local_md5:
-                    print(f"[校驗碼不同] {local_rel}")
-                    os.remove(local_abs)
-                else:
-                    print(f"[檔案缺失] {local_rel}")
-                tasks.append(local_rel)
+    for local_rel, local_abs, value, local_digest in zip(paths, abs_paths, expected, local_digests):
+        if not local_digest or local_digest != value:
+            if local_digest:
+                print(f"[校驗碼不同] {local_rel}")
+                os.remove(local_abs)
             else:
-                print(f"[正確] {local_rel}")
+                print(f"[檔案缺失] {local_rel}")
+            tasks.append(local_rel)
+        else:
+            print(f"[正確] {local_rel}")
     return tasks
 
 
+# --- 伺服器端比對 ---
+def negotiate_algo(session, key):
+    """以 HEAD /{key}?diff=1&algo= 詢問伺服器 diff 使用的演算法；伺服器不支援 diff 時回傳 None"""
+    try:
+        r = session.head(f"{server_url}/{key}?diff=1&algo={DIGEST_ALGO}", timeout=10)
+    except Exception:
+        return None
+    if r.status_code != 200:
+        return None
+    return r.headers.get("X-Digest-Algo")
+
+
+def request_diff(session, key, folder_path):
+    """上傳本地 {相對路徑: 校驗碼}，由伺服器回傳 (需下載的檔案, 伺服器檔案總數)；伺服器不支援時回傳 None
+
+    先協商演算法再計算本地校驗碼，伺服器不支援 DIGEST_ALGO 時只以它確認的演算法計算一次。
+    """
+    algo = negotiate_algo(session, key)
+    if algo is None:
+        return None
+    local_files = scan_folder(folder_path, algo)
+    try:
+        r = session.post(f"{server_url}/{key}?diff=1&algo={algo}", json=local_files, timeout=30)
+        if r.status_code != 200:
+            return None
+        result = r.json()
+        if result.get("algo", algo) != algo:
+            return None
+    except Exception as e:
+        print(f"伺服器比對失敗，改為本地比對: {e}")
+        return None
+
+    # 伺服器的資料夾（含空資料夾）在本地也要存在，部分模組會依賴它們
+    for rel in result.get("dirs", []):
+        os.makedirs(os.path.join(folder_path, rel.replace("/", os.sep)), exist_ok=True)
+    for rel in result["missing"]:
+        print(f"[檔案缺失] {rel}")
+    for rel in result["differ"]:
+        print(f"[校驗碼不同] {rel}")
+        os.remove(os.path.join(folder_path, rel.replace("/", os.sep)))
+    return result["missing"] + result["differ"], result["total"]
+
+
 # --- 主程式 ---
 if __name__ == "__main__":
-    max_workers = 8
-
     for key, info in folders.items():
         folder_path = info["path"]
         force = info["force"]
@@ -174,21 +402,32 @@ if __name__ == "__main__":
                 print(f"[force] 刪除 {folder_path}")
                 shutil.rmtree(folder_path)
             os.makedirs(folder_path)
-            download_and_extract_zip(f"{server_url}/{key}?download=1", folder_path)
+            download_and_extract_zip(session, f"{server_url}/{key}?download=1", folder_path)
             continue
 
-        try:
-            resp = requests.get(f"{server_url}/{key}/?json=1", timeout=10)
-            if resp.status_code != 200:
-                print(f"無法取得服務器檔案列表: {key}")
+        diff = request_diff(session, key, folder_path)
+        if diff is not None:
+            tasks, total_files = diff
+        else:
+            # 舊版伺服器沒有 diff 端點：下載完整校驗碼列表並在本地比對
+            try:
+                resp = session.get(f"{server_url}/{key}/?json=1&algo={DIGEST_ALGO}", timeout=10)
+                if resp.status_code != 200:
+                    print(f"無法取得服務器檔案列表: {key}")
+                    continue
+                server_files = resp.json()
+                # 舊版伺服器不認得 algo 參數，會直接回傳 MD5 結構
+                algo = resp.headers.get("X-Digest-Algo")
+                if algo:
+                    server_files = server_files["digest"]
+                else:
+                    algo = "md5"
+            except Exception as e:
+                print(f"取得檔案列表失敗: {e}")
                 continue
-            server_files = resp.json()
-        except Exception as e:
-            print(f"取得檔案列表失敗: {e}")
-            continue
 
-        tasks = collect_download_tasks(server_files, folder_path)
-        total_files = count_server_files(server_files)
+            tasks = collect_download_tasks(server_files, folder_path, algo=algo)
+            total_files = count_server_files(server_files)
 
         if total_files == 0:
             print(f"{key}: 伺服器資料夾為空，略過。")
@@ -201,11 +440,17 @@ if __name__ == "__main__":
             print(f"[超過一半檔案需要更新] 下載整個資料夾 ZIP")
             shutil.rmtree(folder_path)
             os.makedirs(folder_path)
-            download_and_extract_zip(f"{server_url}/{key}?download=1", folder_path)
+            download_and_extract_zip(session, f"{server_url}/{key}?download=1", folder_path)
+        elif len(tasks) > SMALL_BATCH_THRESHOLD and download_and_extract_zip(
+                session, f"{server_url}/{key}?partial=1", folder_path, tasks):
+            print(f"已以單一 ZIP 取得 {len(tasks)} 個檔案")
         elif tasks:
+            # 伺服器不支援 partial 時也會走到這裡，逐檔下載
             print(f"開始下載 {len(tasks)} 個檔案 ...")
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = [executor.submit(download_file, server_url, key, t, folder_path) for t in tasks]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = [executor.submit(download_file, session, server_url, key, t, folder_path) for t in tasks]
                 concurrent.futures.wait(futures)
         else:
             print("所有檔案均正確，無需下載。")
+
+    save_digest_cache()
@@ -255,11 +255,12 @@ class FileBrowserHandler(BaseHTTPRequestHandler):
                 self.wfile.write(chunk)
 
 
-# 列印檔案列表
-for key, path in folders.items():
-    print(f"{key}:")
-    print(json.dumps(scan_folder_dict(path), indent=2, ensure_ascii=False))
-    print()
+# 列印檔案列表（會計算所有檔案的校驗碼，僅在設定 MODSYNC_DEBUG_SCAN 時執行）
+if os.environ.get("MODSYNC_DEBUG_SCAN"):
+    for key, path in folders.items():
+        print(f"{key}:")
+        print(json.dumps(scan_folder_dict(path), indent=2, ensure_ascii=False))
+        print()
 
 # 啟動 HTTP 服務
 print("Starting HTTP server on http://localhost:8000")
@@ -1,11 +1,22 @@
 import os
-import hashlib
 import io
+import re
+import hashlib
+import gzip
 import zipfile
 import json
 import urllib.parse
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import unquote, quote, urlparse, parse_qs
+import threading
+import concurrent.futures
+import functools
+import mmap
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, quote, urlparse
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 # 讀取 config.txt
 config_file = "config.txt"
@@ -19,83 +30,336 @@ with open(config_file, "r", encoding="utf-8") as f:
         key, path = line.split(":", 1)
         folders[key.strip()] = path.strip().strip('"')
 
+# 計算 MD5 的執行緒數，可用環境變數 MODSYNC_HASH_WORKERS 調整
+HASH_WORKERS = int(os.environ.get("MODSYNC_HASH_WORKERS", (os.cpu_count() or 1) * 5))
+
+# 可供客戶端以 ?algo= 指定的校驗演算法；未指定時維持 MD5 以相容舊客戶端
+SUPPORTED_ALGOS = ("blake3", "md5") if blake3 else ("md5",)
+
+# 每個執行緒重複使用的讀取緩衝區（舊版 Python 沒有 hashlib.file_digest 時使用）
+_read_local = threading.local()
+
+
+def _read_buffer():
+    buf = getattr(_read_local, "buf", None)
+    if buf is None:
+        buf = _read_local.buf = memoryview(bytearray(1 << 20))
+    return buf
+
+
+def _hash_file(file_path, algo):
+    with open(file_path, "rb") as f:
+        if algo == "blake3":
+            if os.fstat(f.fileno()).st_size == 0:
+                return blake3.blake3().hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return blake3.blake3(mm, max_threads=blake3.blake3.AUTO).hexdigest()
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, algo).hexdigest()
+        hasher = hashlib.new(algo)
+        buf = _read_buffer()
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(buf[:n])
+    return hasher.hexdigest()
+
+
+# 校驗碼快取：{完整路徑: (mtime_ns, size, {演算法: 校驗碼})}，檔案未變動時只需一次 stat
+DIGEST_CACHE_FILE = ".digestcache.json"
+
+
+def load_digest_cache():
+    try:
+        with open(DIGEST_CACHE_FILE, "r", encoding="utf-8") as f:
+            return {path: tuple(v) for path, v in json.load(f).items()}
+    except Exception:
+        return {}
+
 
-def get_md5(file_path):
-    """計算檔案 MD5 校驗碼"""
-    hash_md5 = hashlib.md5()
+def save_digest_cache():
     try:
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        with _digest_cache_lock:
+            data = json.dumps(_digest_cache, ensure_ascii=False)
+        with open(DIGEST_CACHE_FILE, "w", encoding="utf-8") as f:
+            f.write(data)
+    except Exception as e:
+        print(f"儲存校驗碼快取失敗: {e}")
+
+
+_digest_cache = load_digest_cache()
+_digest_cache_lock = threading.Lock()  # 多個請求執行緒會同時讀寫快取
+
+
+def get_digest(file_path, algo="md5"):
+    """計算檔案校驗碼（mtime 與大小未變時直接使用快取）
+
+    file_path 也可以是 os.DirEntry，此時沿用掃描時已取得的 stat。
+    """
+    try:
+        if isinstance(file_path, os.DirEntry):
+            st = file_path.stat()
+            file_path = file_path.path
+        else:
+            st = os.stat(file_path)
+        with _digest_cache_lock:
+            cached = _digest_cache.get(file_path)
+            if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                digests = cached[2]
+                if algo in digests:
+                    return digests[algo]
+            else:
+                digests = {}
+                _digest_cache[file_path] = (st.st_mtime_ns, st.st_size, digests)
+        # 計算校驗碼時不持有鎖，避免大檔案卡住其他請求
+        digest = _hash_file(file_path, algo)
+        with _digest_cache_lock:
+            digests[algo] = digest
+        return digest
     except:
         return "error"
 
 
-def scan_folder_dict(folder_path):
+def cached_digest(file_path, st, algo="md5"):
+    """只查快取：mtime 與大小未變且已算過 algo 時回傳校驗碼，否則回傳 None，不讀取檔案"""
+    with _digest_cache_lock:
+        cached = _digest_cache.get(file_path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2].get(algo)
+    return None
+
+
+def scan_folder_dict(folder_path, algo="md5"):
     """遞歸掃描資料夾，返回嵌套 JSON 結構"""
     result = {}
-    try:
-        for entry in os.listdir(folder_path):
-            full_path = os.path.join(folder_path, entry)
-            if os.path.isfile(full_path):
-                result[entry] = get_md5(full_path)
-            elif os.path.isdir(full_path):
-                result[entry] = scan_folder_dict(full_path)
-    except Exception as e:
-        print(f"掃描資料夾失敗: {folder_path}, {e}")
+    # 先走訪目錄建立嵌套結構，收集所有檔案，再平行計算校驗碼填回
+    pending = []  # (所屬 dict, DirEntry)
+    stack = [(folder_path, result)]
+    while stack:
+        current, node = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_file():
+                        node[entry.name] = None
+                        pending.append((node, entry))
+                    elif entry.is_dir(follow_symlinks=False):
+                        node[entry.name] = {}
+                        stack.append((entry.path, node[entry.name]))
+        except Exception as e:
+            print(f"掃描資料夾失敗: {current}, {e}")
+
+    if pending:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            digests = executor.map(functools.partial(get_digest, algo=algo),
+                                   [entry for _, entry in pending])
+            for (node, entry), digest in zip(pending, digests):
+                node[entry.name] = digest
     return result
 
 
+def tree_fingerprint(folder_path):
+    """以路徑、mtime、大小計算資料夾指紋；只需 stat，不讀取檔案內容"""
+    count = 0
+    total = 0
+    stack = [folder_path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_file():
+                        st = entry.stat()
+                        total += hash((entry.path, st.st_mtime_ns, st.st_size))
+                    elif entry.is_dir(follow_symlinks=False):
+                        total += hash(entry.path)
+                        stack.append(entry.path)
+                    else:
+                        continue
+                    count += 1
+        except OSError:
+            pass
+    return count, total
+
+
+# 掃描結果快取：{(資料夾, 演算法): (指紋, 嵌套結構, {是否為舊版格式: (json bytes, gzip bytes)})}
+_scan_cache = {}
+
+
+def scan_tree(folder_path, algo="md5"):
+    """回傳 (指紋, 嵌套結構, 編碼快取)；資料夾指紋未變時直接使用快取，不重新走訪與計算"""
+    fingerprint = tree_fingerprint(folder_path)
+    cached = _scan_cache.get((folder_path, algo))
+    if cached and cached[0] == fingerprint:
+        return cached
+    cached = (fingerprint, scan_folder_dict(folder_path, algo), {})
+    _scan_cache[(folder_path, algo)] = cached
+    return cached
+
+
+def scan_json(folder_path, algo=None):
+    """回傳 (json bytes, gzip bytes)；資料夾指紋未變時直接使用快取
+
+    algo 為 None 時輸出舊版 MD5 嵌套結構，否則輸出 {"algo", "digest"}。
+    """
+    legacy = algo is None
+    _, tree, encoded = scan_tree(folder_path, "md5" if legacy else algo)
+    if legacy not in encoded:
+        payload = tree if legacy else {"algo": algo, "digest": tree}
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+        encoded[legacy] = (body, gzip.compress(body))
+    return encoded[legacy]
+
+
+def flatten_tree(tree, prefix=""):
+    """將嵌套結構攤平成 (以 / 分隔的相對路徑, 校驗碼)"""
+    for name, value in tree.items():
+        rel_path = f"{prefix}/{name}" if prefix else name
+        if isinstance(value, dict):
+            yield from flatten_tree(value, rel_path)
+        else:
+            yield rel_path, value
+
+
+def tree_dirs(tree, prefix=""):
+    """列出嵌套結構中所有資料夾（以 / 分隔的相對路徑），包含空資料夾"""
+    for name, value in tree.items():
+        if isinstance(value, dict):
+            rel_path = f"{prefix}/{name}" if prefix else name
+            yield rel_path
+            yield from tree_dirs(value, rel_path)
+
+
+def accepts_gzip(accept_encoding):
+    """依 Accept-Encoding 判斷客戶端是否接受 gzip；q=0 表示明確拒絕"""
+    accepted = False
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if coding not in ("gzip", "x-gzip", "*"):
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding == "*":
+            # 萬用字元只在沒有明確列出 gzip 時才生效
+            accepted = accepted or q > 0
+            continue
+        return q > 0
+    return accepted
+
+
+# 同一個名稱的 URL 編碼結果固定不變，快取起來避免每次列表都重新計算
+_quote = functools.lru_cache(maxsize=1 << 16)(quote)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _entry_html(base_url, name, full_path, is_dir, mtime_ns=None, size=None):
+    """產生單一項目的 <li>；檔案以 mtime 與大小作為快取鍵的一部分，變動後自動重新產生"""
+    entry_url = base_url + "/" + _quote(name)
+    if is_dir:
+        return f"<li>[DIR] <a href='{entry_url}'>{name}</a> " \
+               f"<a href='{entry_url}?download=1' style='margin-left:10px;'>下載</a></li>"
+    md5 = get_digest(full_path)
+    return f"<li>{name} [{md5}] " \
+           f"<a href='{entry_url}?download=1'>下載</a></li>"
+
+
 def list_dir_html(folder_path, base_url):
     """生成 HTML 列表"""
     if not os.path.exists(folder_path):
         return f"<p>Folder '{folder_path}' not found</p>"
 
-    entries = sorted(os.listdir(folder_path))
-    html = "<ul>"
+    with os.scandir(folder_path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    parts = ["<ul>"]
     for entry in entries:
-        full_path = os.path.join(folder_path, entry)
-        entry_url = base_url + "/" + quote(entry)
-        if os.path.isdir(full_path):
-            html += f"<li>[DIR] <a href='{entry_url}'>{entry}</a> " \
-                    f"<a href='{entry_url}?download=1' style='margin-left:10px;'>下載</a></li>"
+        if entry.is_dir():
+            parts.append(_entry_html(base_url, entry.name, entry.path, True))
         else:
-            md5 = get_md5(full_path)
-            html += f"<li>{entry} [{md5}] " \
-                    f"<a href='{entry_url}?download=1'>下載</a></li>"
-    html += "</ul>"
-    return html
-
-
-def zip_folder(folder_path):
-    """將資料夾打包成 zip，返回 BytesIO"""
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                abs_path = os.path.join(root, file)
-                rel_path = os.path.relpath(abs_path, folder_path)
+            st = entry.stat()
+            parts.append(_entry_html(base_url, entry.name, entry.path, False, st.st_mtime_ns, st.st_size))
+    parts.append("</ul>")
+    return "".join(parts)
+
+
+# 伺服器只用到這幾個查詢參數，直接以正規表示式擷取，不必對每個請求執行 parse_qs
+QUERY_RE = re.compile(r"(?:^|&)(download|json|algo|partial|diff)(?:=([^&]*))?(?=&|$)")
+
+# Range: bytes=start-[end]
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")  # 只支援單一區段的 Range 請求
+
+# 已經壓縮過的格式直接儲存，不再重複 DEFLATE
+STORED_EXTS = {".jar", ".zip", ".gz", ".7z", ".png", ".jpg", ".jpeg", ".ogg"}
+
+
+def folder_files(folder_path):
+    """列出資料夾內所有檔案，產生 (完整路徑, zip 內路徑)"""
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            abs_path = os.path.join(root, file)
+            yield abs_path, os.path.relpath(abs_path, folder_path)
+
+
+def zip_files(files, out):
+    """將 (完整路徑, zip 內路徑) 打包成 zip，邊壓縮邊寫入 out（可為不可 seek 的串流）"""
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
+        for abs_path, rel_path in files:
+            if os.path.splitext(abs_path)[1].lower() in STORED_EXTS:
+                zipf.write(abs_path, rel_path, compress_type=zipfile.ZIP_STORED)
+            else:
                 zipf.write(abs_path, rel_path)
-    zip_buffer.seek(0)
-    return zip_buffer
+
+
+def zip_folder(folder_path, out):
+    """將整個資料夾打包成 zip 寫入 out"""
+    zip_files(folder_files(folder_path), out)
+
+
+class ChunkedWriter(io.RawIOBase):
+    """將寫入的資料包成 HTTP/1.1 chunked 傳輸格式"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            self.wfile.write(b"".join((b"%X\r\n" % len(data), data, b"\r\n")))
+        return len(data)
+
+    def finish(self):
+        self.wfile.write(b"0\r\n\r\n")
 
 
 class FileBrowserHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keep-alive：同一個客戶端連線可連續下載多個檔案
+    protocol_version = "HTTP/1.1"
+
     def do_GET(self):
         url_parts = urlparse(self.path)
         path = unquote(url_parts.path)
-        query = parse_qs(url_parts.query)
+        query = dict(QUERY_RE.findall(url_parts.query))
         download_mode = "download" in query
         json_mode = "json" in query
 
         # 返回設定檔名稱列表
         if path.lstrip("/") == "config_names" and json_mode:
             config_keys = list(folders.keys())
+            body = json.dumps(config_keys, ensure_ascii=False, indent=2).encode('utf-8')
             self.send_response(200)
             self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(json.dumps(config_keys, ensure_ascii=False, indent=2).encode('utf-8'))
+            self.wfile.write(body)
             return
 
         parts = path.lstrip("/").split("/", 1)
@@ -106,61 +370,36 @@ class FileBrowserHandler(BaseHTTPRequestHandler):
 
             # 單檔案
             if os.path.isfile(real_path):
-                if download_mode:
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/octet-stream')
-
-                    file_name = os.path.basename(real_path)
-                    file_name_encoded = urllib.parse.quote(file_name)
-                    self.send_header('Content-Disposition',
-                    f"attachment; filename*=UTF-8''{file_name_encoded}; filename=\"{file_name.encode('ascii', 'ignore').decode('ascii')}\"")
-                    self.send_header('Content-Length', str(os.path.getsize(real_path)))
-                    self.end_headers()
-                    # 分塊傳輸
-                    with open(real_path, 'rb') as f:
-                        while True:
-                            chunk = f.read(8192)
-                            if not chunk:
-                                break
-                            self.wfile.write(chunk)
-                    return
-                else:
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/octet-stream')
-                    self.end_headers()
-                    with open(real_path, 'rb') as f:
-                        while True:
-                            chunk = f.read(8192)
-                            if not chunk:
-                                break
-                            self.wfile.write(chunk)
-                    return
+                self.send_file(real_path, download_mode)
+                return
 
             # 資料夾
             elif os.path.isdir(real_path):
                 if download_mode:
-                    zip_bytes = zip_folder(real_path)
                     zip_name = os.path.basename(real_path.rstrip(os.sep)) + ".zip"
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/zip')
-                    zip_name = os.path.basename(real_path.rstrip(os.sep)) + ".zip"
-                    zip_name_encoded = urllib.parse.quote(zip_name)
-                    self.send_header('Content-Disposition',
-                        f"attachment; filename*=UTF-8''{zip_name_encoded}; filename=\"{zip_name.encode('ascii', 'ignore').decode('ascii')}\"")
-                    self.send_header('Content-Length', str(len(zip_bytes.getvalue())))
-                    self.end_headers()
-                    while True:
-                        chunk = zip_bytes.read(8192)
-                        if not chunk:
-                            break
-                        self.wfile.write(chunk)
+                    self.send_zip(zip_name, folder_files(real_path))
                     return
                 elif json_mode:
-                    files_md5 = scan_folder_dict(real_path)
+                    # 客戶端以 ?algo= 協商演算法時回傳 {"algo", "digest"}；否則維持舊版 MD5 結構
+                    algo = None
+                    if "algo" in query:
+                        algo = query["algo"]
+                        if algo not in SUPPORTED_ALGOS:
+                            algo = "md5"
+                    body, body_gz = scan_json(real_path, algo)
+                    use_gzip = accepts_gzip(self.headers.get('Accept-Encoding', ""))
+                    if use_gzip:
+                        body = body_gz
                     self.send_response(200)
                     self.send_header('Content-Type', 'application/json; charset=utf-8')
+                    if use_gzip:
+                        self.send_header('Content-Encoding', 'gzip')
+                    self.send_header('Vary', 'Accept-Encoding')
+                    if algo:
+                        self.send_header('X-Digest-Algo', algo)
+                    self.send_header('Content-Length', str(len(body)))
                     self.end_headers()
-                    self.wfile.write(json.dumps(files_md5, ensure_ascii=False, indent=2).encode('utf-8'))
+                    self.wfile.write(body)
                     return
                 else:
                     html = f"<h2>Folder: /{parts[0]}"
@@ -169,32 +408,224 @@ class FileBrowserHandler(BaseHTTPRequestHandler):
                     html += "</h2>"
                     html += list_dir_html(real_path, "/" + parts[0] + ("/" + sub_path if sub_path else ""))
                     html += "<hr><a href='/'>返回首頁</a>"
+                    body = html.encode('utf-8')
                     self.send_response(200)
                     self.send_header('Content-Type', 'text/html; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
                     self.end_headers()
-                    self.wfile.write(html.encode('utf-8'))
+                    self.wfile.write(body)
                     return
 
         # 首頁
-        html = "<h2>根目錄</h2><ul>"
+        parts = ["<h2>根目錄</h2><ul>"]
         for key in folders:
-            html += f"<li>[DIR] <a href='/{key}'>{key}</a> " \
-                    f"<a href='/{key}?download=1' style='margin-left:10px;'>下載</a></li>"
-        html += "</ul>"
+            parts.append(f"<li>[DIR] <a href='/{key}'>{key}</a> "
+                         f"<a href='/{key}?download=1' style='margin-left:10px;'>下載</a></li>")
+        parts.append("</ul>")
+        body = "".join(parts).encode('utf-8')
         self.send_response(200)
         self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(html.encode('utf-8'))
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        """HEAD /{key}?diff=1&algo=...：不掃描資料夾，只以 X-Digest-Algo 告知 diff 會使用的演算法"""
+        url_parts = urlparse(self.path)
+        key = unquote(url_parts.path).strip("/")
+        query = dict(QUERY_RE.findall(url_parts.query))
+        if key not in folders or "diff" not in query:
+            self.send_error(404, "Not found")
+            return
+        algo = query.get("algo")
+        if algo not in SUPPORTED_ALGOS:
+            algo = "md5"
+        self.send_response(200)
+        self.send_header('X-Digest-Algo', algo)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        url_parts = urlparse(self.path)
+        key = unquote(url_parts.path).strip("/")
+        query = dict(QUERY_RE.findall(url_parts.query))
+
+        # 先讀完請求內容再回應錯誤，keep-alive 連線上才不會把殘留的 body 當成下一個請求
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.close_connection = True
+            self.send_error(400, "Invalid Content-Length")
+            return
+        body = self.rfile.read(length) if length > 0 else b""
+
+        if key not in folders or not ("partial" in query or "diff" in query):
+            self.send_error(404, "Not found")
+            return
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.send_error(400, "Invalid JSON body")
+            return
+        # ?partial 需要字串陣列，?diff 需要 {字串: 字串}
+        if "diff" in query:
+            valid = isinstance(data, dict) and all(isinstance(v, str) for v in data.values())
+        else:
+            valid = isinstance(data, list) and all(isinstance(v, str) for v in data)
+        if not valid:
+            self.send_error(400, "Unexpected JSON body")
+            return
+
+        # POST /{key}?diff=1&algo=...，內容為客戶端 {相對路徑: 校驗碼}，回傳缺失與不同的檔案及所有資料夾
+        if "diff" in query:
+            algo = query.get("algo") or "md5"
+            if algo not in SUPPORTED_ALGOS:
+                self.send_error(400, f"Unsupported algo: {algo}")
+                return
+            _, tree, _ = scan_tree(folders[key], algo)
+            server_files = dict(flatten_tree(tree))
+            result = {
+                "algo": algo,
+                "total": len(server_files),
+                "dirs": list(tree_dirs(tree)),
+                "missing": [rel for rel in server_files if rel not in data],
+                "differ": [rel for rel, digest in server_files.items() if rel in data and data[rel] != digest],
+            }
+            body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # POST /{key}?partial=1，內容為相對路徑 JSON 陣列，回傳只含這些檔案的 zip
+        # 只接受資料夾內的檔案，避免 ../ 跳出
+        base = os.path.realpath(folders[key])
+        files = []
+        for rel_path in data:
+            abs_path = os.path.realpath(os.path.join(base, rel_path.replace("/", os.sep)))
+            if abs_path.startswith(base + os.sep) and os.path.isfile(abs_path):
+                files.append((abs_path, rel_path))
+        self.send_zip(f"{key}.zip", files)
+
+    # ------------------- 輔助函數 -------------------
+    def send_zip(self, zip_name, files):
+        """邊壓縮邊傳送 zip。HTTP/1.1 使用 chunked 編碼，HTTP/1.0 客戶端則以關閉連線標示結尾"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        zip_name_encoded = urllib.parse.quote(zip_name)
+        self.send_header('Content-Disposition',
+            f"attachment; filename*=UTF-8''{zip_name_encoded}; filename=\"{zip_name.encode('ascii', 'ignore').decode('ascii')}\"")
+        chunked = self.request_version != "HTTP/1.0"
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+        try:
+            if chunked:
+                writer = ChunkedWriter(self.wfile)
+                out = io.BufferedWriter(writer, 1 << 16)
+                zip_files(files, out)
+                out.flush()
+                writer.finish()
+            else:
+                zip_files(files, self.wfile)
+        except (ConnectionResetError, BrokenPipeError):
+            self.close_connection = True
+            print(f"[警告] 客戶端中斷下載: {zip_name}")
+
+    def send_file(self, file_path, download_mode=False):
+        """傳送單一檔案，支援 Range 續傳與 If-None-Match"""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            self.send_error(404, f"{file_path} not found")
+            return
+        size = st.st_size
+
+        # ETag 優先使用快取中的 MD5；尚未算過時改用 mtime 與大小，送出標頭前不讀取整個檔案
+        digest = cached_digest(file_path, st)
+        etag = f'"{digest}"' if digest and digest != "error" else f'"{st.st_mtime_ns:x}-{size:x}"'
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match and (
+                if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        match = RANGE_RE.match(self.headers.get('Range', "").strip())
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            else:
+                # bytes=-N：最後 N 個位元組
+                start = max(0, size - int(match.group(2)))
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if download_mode:
+            file_name = os.path.basename(file_path)
+            file_name_encoded = urllib.parse.quote(file_name)
+            self.send_header('Content-Disposition',
+                f"attachment; filename*=UTF-8''{file_name_encoded}; filename=\"{file_name.encode('ascii', 'ignore').decode('ascii')}\"")
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(file_path, 'rb') as f:
+            self.send_file_range(f, start, end - start + 1)
+
+    def send_file_range(self, f, offset, remaining):
+        """將 f 從 offset 起的 remaining 位元組送出；有 os.sendfile 時在核心內直接傳送"""
+        if hasattr(os, "sendfile"):
+            self.wfile.flush()
+            out_fd = self.connection.fileno()
+            while remaining > 0:
+                sent = os.sendfile(out_fd, f.fileno(), offset, remaining)
+                if not sent:
+                    break
+                offset += sent
+                remaining -= sent
+            return
+        # Windows 沒有 os.sendfile，改用 1 MiB 分塊傳輸
+        f.seek(offset)
+        while remaining > 0:
+            chunk = f.read(min(1 << 20, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
 
 
-# 列印檔案列表
-for key, path in folders.items():
-    print(f"{key}:")
-    print(json.dumps(scan_folder_dict(path), indent=2, ensure_ascii=False))
-    print()
+# 列印檔案列表（會計算所有檔案的校驗碼，僅在設定 MODSYNC_DEBUG_SCAN 時執行）
+if os.environ.get("MODSYNC_DEBUG_SCAN"):
+    for key, path in folders.items():
+        print(f"{key}:")
+        print(json.dumps(scan_folder_dict(path), indent=2, ensure_ascii=False))
+        print()
 
 # 啟動 HTTP 服務
 print("Starting HTTP server on http://localhost:8000")
 server_address = ('', 8000)
-httpd = HTTPServer(server_address, FileBrowserHandler)
-httpd.serve_forever()
+httpd = ThreadingHTTPServer(server_address, FileBrowserHandler)
+httpd.daemon_threads = True
+try:
+    httpd.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    save_digest_cache()
@@ -1,16 +1,47 @@
 import os
+import re
 import hashlib
 import io
+import mmap
+import copy
+import struct
 import zipfile
+import zlib
 import json
 import urllib.parse
+import email.utils
 import threading
 import concurrent.futures
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import collections
+import socket
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import unquote, quote, urlparse, parse_qs
 import sys
 import time
-import shutil
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    # ISA-L 的 crc32 使用 PCLMULQDQ 指令，比 zlib 的查表實作快上數倍
+    from isal.isal_zlib import crc32
+except ImportError:
+    crc32 = zlib.crc32
+
+try:
+    # python-isal 的 isal_zlib 與 zlib 介面相容，以 ISA-L 加速 DEFLATE（只支援等級 0～3）。
+    # 只有 deflate_file（執行緒池平行壓縮的小檔案）使用它；zip_write、update_zip 與 stream_zip
+    # 經由 zipfile 壓縮，仍是標準 zlib
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+try:
+    import orjson  # 較快的 JSON 編碼器，未安裝時使用標準 json
+except ImportError:
+    orjson = None
 
 # -------------------- 配置檔與資料夾 --------------------
 CONFIG_FILE = "config.txt"
@@ -19,14 +50,64 @@ CLIENT_VERSION_FILE = os.path.join(CLIENT_UPDATE_DIR, "version.txt")
 
 CACHE_DIR = os.path.join(os.getcwd(), "cache_zip")
 HASH_RECORD_FILE = os.path.join(CACHE_DIR, "hash_record.json")
+BLOB_DIR = os.path.join(CACHE_DIR, "blobs")  # 依內容雜湊存放的壓縮資料，各資料夾共用
 os.makedirs(CACHE_DIR, exist_ok=True)
 
 folders = {}          # key -> folder_path
 cache_files = {}      # key -> zip_path
+hash_json_cache = {}  # (key, 是否附帶演算法) -> 預先編碼好的 ?json 回應
+hash_record_lock = threading.Lock()
+hash_record = {}      # 最近一次的完整掃描記錄（與 hash_record.json 相同）
+zip_etags = {}           # key -> 依資料夾內容計算的 zip ETag
+current_files = {}       # key -> 目前的 {相對路徑: 雜湊}
+zip_built_digest = {}    # key -> 磁碟上的 zip 建立時的資料夾指紋
+zip_base_files = {}      # key -> 磁碟上的 zip 對應的 {相對路徑: 雜湊}，供增量更新
+zip_locks = {}           # key -> 建立 zip 用的鎖，同一個資料夾同時只有一個執行緒在壓縮
+zip_request_counts = {}  # key -> 以串流方式下載整包的次數
+zip_build_lock = threading.Lock()
+zip_building = set()     # 背景建立中的 zip 快取
+
+# -------------------- 內容雜湊 --------------------
+# 檔案指紋演算法，可用環境變數 MODSYNC_HASH_ALGO=blake3 切換（需安裝 blake3）。
+# 預設維持 MD5：現有 GUI 客戶端是以 MD5 比對 ?json 的結果。
+HASH_ALGO = os.environ.get("MODSYNC_HASH_ALGO", "md5").lower()
+if HASH_ALGO == "blake3" and blake3 is None:
+    print("⚠️ 未安裝 blake3，改用 md5")
+    HASH_ALGO = "md5"
+elif HASH_ALGO != "blake3" and HASH_ALGO not in hashlib.algorithms_available:
+    print(f"⚠️ 不支援的雜湊演算法 {HASH_ALGO}，改用 md5")
+    HASH_ALGO = "md5"
+HASH_ALGO_KEY = "__hash_algo__"  # hash_record.json 中記錄演算法的欄位
+ZIP_DIGEST_KEY = "__zip_digest__"  # hash_record.json 中記錄各 zip 建立時資料夾指紋的欄位
+MMAP_THRESHOLD = 16 << 20           # 超過此大小的檔案以 mmap 一次交給雜湊函式
+HASH_WORKERS = os.cpu_count() or 1  # 平行計算雜湊的執行緒數
+# 修改時間距掃描不到此時間的檔案，同一個 mtime 內可能還會被再次寫入，不能信任 stat 快取
+RACE_WINDOW_NS = 2_000_000_000
+
+# -------------------- ZIP 壓縮 --------------------
+# 已經壓縮過的格式（jar 本身就是 zip）再 DEFLATE 一次幾乎不會變小，直接 STORED 省下 CPU
+STORED_EXTS = {".jar", ".zip", ".png", ".jpg", ".jpeg", ".ogg", ".mp3", ".gz", ".xz", ".7z"}
+ZIP_COMPRESSLEVEL = int(os.environ.get("MODSYNC_ZIP_LEVEL", "6"))  # DEFLATE 等級 1（快）~ 9（小）
+if isal_zlib is not None and ZIP_COMPRESSLEVEL > 3:
+    print(f"⚠️ ISA-L 只支援 DEFLATE 等級 0～3：平行壓縮的小檔案改用等級 3，其餘檔案仍使用等級 {ZIP_COMPRESSLEVEL}")
+PARALLEL_DEFLATE_MAX = 32 << 20  # 小於此大小的檔案整個讀進記憶體，由多個執行緒同時壓縮
+PARALLEL_DEFLATE_BUDGET = 128 << 20  # 平行壓縮中（尚未寫入 zip）的原始檔案總大小上限
+
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")  # 只支援單一區段的 Range 請求
+COPY_BUFSIZE = 1 << 20
+# 沒有磁碟快取的資料夾被串流下載達此次數後，於背景建立 zip 快取
+STREAM_CACHE_HITS = int(os.environ.get("MODSYNC_STREAM_CACHE_HITS", "3"))
+# 固定的送出緩衝大小（位元組）。預設 0 表示不設定：手動設定 SO_SNDBUF 會關閉 Linux 的自動調整，
+# 高延遲連線反而可能變慢；只在確定需要時以 MODSYNC_SNDBUF 開啟
+SOCKET_SNDBUF = int(os.environ.get("MODSYNC_SNDBUF", "0"))
 
 # -------------------- 忽略規則 --------------------
 IGNORE_PREFIXES = ["serveronly_"]
 IGNORE_NAMES = ["ignore_me.txt"]  # 可自行擴展
+# 兩份清單編譯成單一正規表示式，每個檔名只需比對一次
+_IGNORE_RE = re.compile(
+    "|".join([re.escape(p) for p in IGNORE_PREFIXES] + [re.escape(n) + r"\Z" for n in IGNORE_NAMES]) or r"(?!)"
+)
 
 # -------------------- 載入 config.txt --------------------
 with open(CONFIG_FILE, "r", encoding="utf-8") as f:
@@ -37,48 +118,448 @@ with open(CONFIG_FILE, "r", encoding="utf-8") as f:
         key, path = line.split(":", 1)
         folders[key.strip()] = path.strip().strip('"')
 
+# 資料夾清單啟動後不會變動，/config_names?json 直接回傳預先編碼好的內容
+CONFIG_NAMES_JSON = json.dumps(list(folders.keys()), ensure_ascii=False, indent=2).encode("utf-8")
+
 # -------------------- 工具函數 --------------------
 def should_ignore(file_name):
     """判斷檔案是否應該被忽略"""
-    return any(file_name.startswith(p) for p in IGNORE_PREFIXES) or file_name in IGNORE_NAMES
+    return _IGNORE_RE.match(file_name) is not None
+
+def advise_sequential(f):
+    """提示核心此檔案會從頭循序讀取，加大預讀視窗（僅支援 posix_fadvise 的平台）"""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+def new_hasher():
+    if HASH_ALGO == "blake3":
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    return hashlib.new(HASH_ALGO)
 
-def get_md5(file_path):
-    """取得檔案 MD5"""
-    hash_md5 = hashlib.md5()
+def get_content_hash(file_path):
+    """取得檔案內容雜湊（演算法見 HASH_ALGO）"""
+    hasher = new_hasher()
     try:
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(8192), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            advise_sequential(f)
+            if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hasher.update(mm)
+            else:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    hasher.update(chunk)
+        return hasher.hexdigest()
     except Exception:
         return "error"
 
-def scan_folder_dict(folder_path):
-    """遞迴掃描資料夾，返回 {相對路徑: md5}"""
+def iter_files(root):
+    """以 os.scandir 遞迴列出 root 底下的檔案（略過忽略清單），產生 DirEntry
+
+    不進入符號連結的資料夾；DirEntry 會快取檔案類型與 stat 結果，可直接給呼叫端重複使用。
+    不存在或無法讀取的資料夾會略過（與 os.walk 相同）。
+    """
+    try:
+        it = os.scandir(root)
+    except OSError as e:
+        print(f"掃描資料夾失敗: {root}, {e}")
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file() and not should_ignore(entry.name):
+                yield entry
+
+def scan_folder_dict(folder_path, previous=None, executor=None):
+    """遞迴掃描資料夾，返回 {相對路徑: [雜湊, inode, mtime_ns, size]}
+
+    previous 為上次的掃描結果；inode、mtime 與大小都沒變的檔案直接沿用舊的雜湊，不重新讀檔。
+    Windows 的 DirEntry 不提供 inode，只比對 mtime 與大小。
+    需要重新計算的檔案交給 executor 平行處理，未提供時自行建立執行緒池。
+    掃描當下才剛修改的檔案，記錄的 mtime 設為 -1，下次掃描一定重新計算（見 RACE_WINDOW_NS）。
+    """
+    previous = previous or {}
     result = {}
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            if should_ignore(file):
-                continue
-            abs_path = os.path.join(root, file)
-            rel_path = os.path.relpath(abs_path, folder_path)
-            result[rel_path] = get_md5(abs_path)
+    misses = []  # (相對路徑, 完整路徑)
+    recent = []  # (相對路徑, mtime_ns)：可能還在寫入中的檔案
+    fine_mtime = False
+    now_ns = time.time_ns()
+    for entry in iter_files(folder_path):
+        st = entry.stat()
+        fine_mtime = fine_mtime or st.st_mtime_ns % 1_000_000_000 != 0
+        ino = 0 if os.name == "nt" else st.st_ino
+        rel_path = os.path.relpath(entry.path, folder_path)
+        old = previous.get(rel_path)
+        if isinstance(old, list) and old[1:] == [ino, st.st_mtime_ns, st.st_size]:
+            result[rel_path] = [old[0], ino, st.st_mtime_ns, st.st_size]
+        else:
+            result[rel_path] = [None, ino, st.st_mtime_ns, st.st_size]
+            misses.append((rel_path, entry.path))
+        if now_ns - st.st_mtime_ns < RACE_WINDOW_NS:
+            recent.append((rel_path, st.st_mtime_ns))
+
+    # 所有 mtime 都是整秒時視為低精度檔案系統（FAT 為 2 秒），使用完整的視窗；否則 1 秒即可
+    window = RACE_WINDOW_NS if not fine_mtime else RACE_WINDOW_NS // 2
+    for rel_path, mtime_ns in recent:
+        if now_ns - mtime_ns < window:
+            result[rel_path][2] = -1
+
+    if misses:
+        abs_paths = [abs_path for _, abs_path in misses]
+        if executor is None:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_WORKERS) as own_executor:
+                hashes = list(own_executor.map(get_content_hash, abs_paths))
+        else:
+            hashes = list(executor.map(get_content_hash, abs_paths))
+        for (rel_path, _), content_hash in zip(misses, hashes):
+            result[rel_path][0] = content_hash
     return result
 
-def zip_folder(folder_path, zip_path):
-    """壓縮資料夾（忽略指定檔案），顯示進度"""
+def hash_map(record):
+    """從掃描記錄取出 {相對路徑: 雜湊}（相容舊版只存 md5 字串的記錄）"""
+    return {rel_path: v[0] if isinstance(v, list) else v for rel_path, v in record.items()}
+
+def is_stored(rel_path):
+    """已壓縮過的格式，在 zip 中以 STORED 存放"""
+    return os.path.splitext(rel_path)[1].lower() in STORED_EXTS
+
+def zip_write(zipf, abs_path, rel_path):
+    """寫入單一檔案，已壓縮過的格式以 STORED 存放"""
+    if is_stored(rel_path):
+        zipf.write(abs_path, rel_path, compress_type=zipfile.ZIP_STORED)
+    else:
+        zipf.write(abs_path, rel_path)
+
+def append_raw_entry(dst, info, chunks):
+    """把已壓縮好的資料（chunks）當作一個項目寫進 dst
+
+    zipfile 沒有公開的原始寫入介面，這裡照著 ZipFile.write 的做法直接寫 dst.fp 並登記到中央目錄。
+    info 需已填好 CRC、file_size、compress_size 與 compress_type。
+    """
+    info.flag_bits &= ~0x08  # CRC 與大小已知，寫在本地標頭，不需要 data descriptor
+    info.extra = b""         # zip64 欄位由 FileHeader / 中央目錄依大小重新產生
+    info.header_offset = dst.fp.tell()
+    dst.fp.write(info.FileHeader())
+    for chunk in chunks:
+        dst.fp.write(chunk)
+    dst.filelist.append(info)
+    dst.NameToInfo[info.filename] = info
+    dst.start_dir = dst.fp.tell()
+    dst._didModify = True
+
+def copy_raw_entry(src, dst, info):
+    """把 src 中的項目連同壓縮後的資料原封不動寫進 dst（不解壓、不重新壓縮）"""
+    src.fp.seek(info.header_offset)
+    header = src.fp.read(zipfile.sizeFileHeader)
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    src.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_len + extra_len)
+
+    def read_chunks():
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = src.fp.read(min(1 << 20, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f"{info.filename} 資料不完整")
+            yield chunk
+            remaining -= len(chunk)
+
+    append_raw_entry(dst, copy.copy(info), read_chunks())
+
+# -------------------- 壓縮資料庫（依內容去重） --------------------
+# 每個 blob 為：CRC32、原始大小，接著是 raw DEFLATE 資料。
+# 不同資料夾（或重建前後）內容相同的檔案只需壓縮一次。
+BLOB_HEADER = struct.Struct("<IQ")
+
+def blob_path(content_hash):
+    return os.path.join(BLOB_DIR, content_hash[:2], content_hash + ".deflate")
+
+def load_blob(content_hash):
+    """返回 (CRC32, 原始大小, 壓縮後資料)，沒有此 blob 時返回 None"""
+    try:
+        with open(blob_path(content_hash), "rb") as f:
+            crc, file_size = BLOB_HEADER.unpack(f.read(BLOB_HEADER.size))
+            return crc, file_size, f.read()
+    except (OSError, struct.error):
+        return None
+
+def store_blob(content_hash, crc, file_size, data):
+    path = blob_path(content_hash)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(BLOB_HEADER.pack(crc, file_size))
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"[警告] 無法寫入壓縮快取 {content_hash}: {e}")
+
+def prune_blobs(live_hashes):
+    """刪除目前沒有任何檔案使用的 blob"""
+    if not os.path.isdir(BLOB_DIR):
+        return
+    removed = 0
+    for sub in os.scandir(BLOB_DIR):
+        if not sub.is_dir():
+            continue
+        for entry in os.scandir(sub.path):
+            if entry.name.removesuffix(".deflate") not in live_hashes:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+    if removed:
+        print(f"🧹 已清除 {removed} 個不再使用的壓縮快取")
+
+def new_compressor():
+    """建立 deflate_file 用的 raw DEFLATE 壓縮器
+
+    有 ISA-L 時使用它，等級限制在其支援的 0～3（啟動時會提示）；其他壓縮路徑不經過這裡。
+    """
+    if isal_zlib is not None:
+        return isal_zlib.compressobj(min(ZIP_COMPRESSLEVEL, 3), isal_zlib.DEFLATED, -15)
+    return zlib.compressobj(ZIP_COMPRESSLEVEL, zlib.DEFLATED, -15)
+
+def deflate_file(abs_path, rel_path, content_hash=None):
+    """讀檔並以 DEFLATE 壓縮成 zip 項目，返回 (ZipInfo, 壓縮後資料)
+
+    zlib 壓縮時會釋放 GIL，可以放在執行緒池中同時處理多個檔案。STORED 的檔案不經過這裡。
+    有 content_hash 時先查壓縮資料庫，命中就不必讀檔與壓縮；未命中則壓縮後存入。
+    """
+    info = zipfile.ZipInfo.from_file(abs_path, rel_path)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    if content_hash and content_hash != "error":
+        blob = load_blob(content_hash)
+        if blob is not None:
+            info.CRC, info.file_size, data = blob
+            info.compress_size = len(data)
+            return info, data
+
+    with open(abs_path, "rb") as f:
+        advise_sequential(f)
+        data = f.read()
+    info.file_size = len(data)
+    info.CRC = crc32(data)
+    compressor = new_compressor()
+    raw = data
+    data = compressor.compress(raw) + compressor.flush()
+    if content_hash and content_hash != "error":
+        # 檔案可能在掃描後又被修改，確認內容仍符合雜湊才存入
+        hasher = new_hasher()
+        hasher.update(raw)
+        if hasher.hexdigest() == content_hash:
+            store_blob(content_hash, info.CRC, info.file_size, data)
+    info.compress_size = len(data)
+    return info, data
+
+def update_zip(folder_path, zip_path, old_files, new_files):
+    """增量更新既有的 zip：未變動的檔案直接複製壓縮資料，只壓縮新增或修改的檔案
+
+    old_files / new_files 為 {相對路徑: 雜湊}；先寫到暫存檔，完成後才取代舊的 zip。
+    """
+    # zip 內的路徑一律使用 "/"
+    unchanged = {rel.replace(os.sep, "/") for rel, h in new_files.items() if old_files.get(rel) == h}
+    tmp_path = zip_path + ".tmp"
+    copied = set()
+    start_time = time.time()
+    with zipfile.ZipFile(zip_path) as src, \
+            zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as dst:
+        for info in src.infolist():
+            if info.filename in unchanged:
+                copy_raw_entry(src, dst, info)
+                copied.add(info.filename)
+        changed = [rel for rel in new_files if rel.replace(os.sep, "/") not in copied]
+        for rel_path in changed:
+            zip_write(dst, os.path.join(folder_path, rel_path), rel_path)
+    os.replace(tmp_path, zip_path)
+    removed = len(old_files.keys() - new_files.keys())
+    print(f"[{os.path.basename(zip_path)}] 增量更新: 沿用 {len(copied)}、重新壓縮 {len(changed)}、"
+          f"移除 {removed} 個檔案 用時: {time.time() - start_time:.1f}s")
+
+class SocketRawWriter(io.RawIOBase):
+    """把 handler 的 wfile 包成 RawIOBase，供 BufferedWriter 緩衝；關閉時不會連帶關閉 wfile
+
+    連線中斷後其餘寫入直接丟棄，避免 BufferedWriter 被回收時再次送出而報錯。
+    """
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._broken = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if not self._broken:
+            try:
+                self._wfile.write(b)
+            except OSError:
+                self._broken = True
+                raise
+        return len(b)
+
+def stream_zip(folder_path, out):
+    """邊壓縮邊把 zip 寫進不可 seek 的 out（例如 socket），不產生中間檔
+
+    zipfile 偵測到無法 seek 時會改用 data descriptor 記錄 CRC 與大小。
+    開啟前就讀不到的檔案（例如剛被刪除）略過並記錄；已開始寫入後才出錯則中止，
+    且不寫中央目錄，讓客戶端解壓失敗，而不是拿到一個看似完整、實際缺檔的 zip。
+    """
+    zipf = zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL)
+    try:
+        for entry in iter_files(folder_path):
+            offset = zipf.fp.tell()
+            try:
+                zip_write(zipf, entry.path, os.path.relpath(entry.path, folder_path))
+            except OSError as e:
+                if isinstance(e, ConnectionError) or zipf.fp.tell() != offset:
+                    raise
+                print(f"[警告] 無法讀取，已從 zip 略過: {entry.path}, {e}")
+    except BaseException:
+        zipf.fp = None  # close() 看到 fp 為 None 就不會寫出中央目錄
+        raise
+    zipf.close()
+
+def count_stream_request(key):
+    """累計 ?stream=1 的下載次數；常被下載但快取不是最新的資料夾在背景建立 zip"""
+    with zip_build_lock:
+        zip_request_counts[key] = zip_request_counts.get(key, 0) + 1
+        if zip_request_counts[key] < STREAM_CACHE_HITS:
+            return
+    build_zip_in_background(key)
+
+def build_zip_in_background(key):
+    """在背景執行緒建立 key 的 zip 快取；已是最新或已在建立中時不做事"""
+    with zip_build_lock:
+        if key in zip_building or zip_is_current(key):
+            return
+        zip_building.add(key)
+
+    def build():
+        try:
+            ensure_zip(key)
+        except Exception as e:
+            print(f"[快取失敗] {key}: {e}")
+        finally:
+            with zip_build_lock:
+                zip_building.discard(key)
+
+    threading.Thread(target=build, daemon=True).start()
+
+def zip_is_current(key):
+    zip_path = os.path.join(CACHE_DIR, f"{key}.zip")
+    return zip_built_digest.get(key) == zip_etags[key].strip('"') and os.path.exists(zip_path)
+
+def refresh_folder(key):
+    """重新掃描單一資料夾並更新記錄、ETag 與 ?json 回應
+
+    有 stat 快取，未變動的檔案不會重新讀取；只在呼叫端持有該資料夾的 zip 鎖時使用。
+    """
+    with hash_record_lock:
+        previous = hash_record.get(key)
+    record = scan_folder_dict(folders[key], previous)
+    files = hash_map(record)
+    changed = files != current_files.get(key)
+    current_files[key] = files
+    zip_etags[key] = f'"{folder_digest(files)}"'
+    with hash_record_lock:
+        hash_record[key] = record
+    if changed:
+        print(f"🔁 {key} 的內容在啟動後有變動，已更新雜湊記錄")
+        publish_hash_record(hash_record)
+
+def ensure_zip(key):
+    """建立或更新 key 的 zip 快取（已是最新則直接返回），返回 zip 路徑
+
+    每個資料夾有自己的鎖：同時呼叫時只有一個執行緒壓縮，其餘等待後直接使用結果。
+    建立前先重新掃描，zip 的 ETag 與記錄都以實際壓縮時的內容為準，而不是啟動時的快照。
+    """
+    with zip_build_lock:
+        lock = zip_locks.setdefault(key, threading.Lock())
+    zip_path = os.path.join(CACHE_DIR, f"{key}.zip")
+    with lock:
+        refresh_folder(key)
+        if not zip_is_current(key):
+            files = current_files[key]
+            print(f"♻️ 建立 {key} 的 zip 快取...")
+            rebuild_zip(key, zip_base_files.get(key), files)
+            zip_built_digest[key] = folder_digest(files)
+            zip_base_files[key] = files
+            cache_files[key] = zip_path
+            print(f"[快取更新完成] {key}")
+        with hash_record_lock:
+            hash_record[ZIP_DIGEST_KEY] = dict(zip_built_digest)
+            save_hash_record(hash_record)
+    return zip_path
+
+def rebuild_zip(key, old_files, new_files):
+    """有舊的 zip 與記錄時增量更新，否則（或更新失敗時）整包重新壓縮"""
+    zip_path = os.path.join(CACHE_DIR, f"{key}.zip")
+    if old_files is not None and os.path.exists(zip_path):
+        try:
+            update_zip(folders[key], zip_path, old_files, new_files)
+            return
+        except (zipfile.BadZipFile, OSError) as e:
+            print(f"[增量更新失敗，改為完整重建] {key}: {e}")
+    # 先寫到暫存檔再取代，正在傳送舊 zip 的連線不受影響
+    tmp_path = zip_path + ".tmp"
+    zip_folder(folders[key], tmp_path, new_files)
+    os.replace(tmp_path, zip_path)
+
+def zip_folder(folder_path, zip_path, files_hash=None):
+    """壓縮資料夾（忽略指定檔案），顯示進度
+
+    需要 DEFLATE 的小檔案交給執行緒池平行壓縮，再依原順序寫入；
+    大檔案與 STORED 的檔案在輪到時以 zipfile 串流寫入，避免整個讀進記憶體。
+    提供 files_hash（{相對路徑: 雜湊}）時，小檔案的壓縮結果會透過壓縮資料庫重複使用。
+    """
+    files_hash = files_hash or {}
     files_to_zip = [
-        (os.path.join(root, file), os.path.relpath(os.path.join(root, file), folder_path))
-        for root, dirs, files in os.walk(folder_path)
-        for file in files if not should_ignore(file)
+        (entry.path, os.path.relpath(entry.path, folder_path), entry.stat().st_size)
+        for entry in iter_files(folder_path)
     ]
     total_files = len(files_to_zip)
     done = 0
     start_time = time.time()
+    in_flight = 0  # 已送出但尚未寫入 zip 的原始位元組數；每個檔案同時持有原始與壓縮資料
+
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zipf, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        pending = collections.deque()
+        next_index = 0
 
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for abs_path, rel_path in files_to_zip:
-            zipf.write(abs_path, rel_path)
+        def fill():
+            """依總位元組數（而非檔案數）補滿平行壓縮的視窗；佇列為空時至少送出一個"""
+            nonlocal next_index, in_flight
+            while next_index < total_files:
+                abs_path, rel_path, size = files_to_zip[next_index]
+                parallel = size < PARALLEL_DEFLATE_MAX and not is_stored(rel_path)
+                cost = size if parallel else 0
+                if pending and in_flight + cost > PARALLEL_DEFLATE_BUDGET:
+                    break
+                future = None
+                if parallel:
+                    future = executor.submit(deflate_file, abs_path, rel_path, files_hash.get(rel_path))
+                pending.append((abs_path, rel_path, cost, future))
+                in_flight += cost
+                next_index += 1
+
+        fill()
+        while pending:
+            abs_path, rel_path, cost, future = pending.popleft()
+            if future is None:
+                zip_write(zipf, abs_path, rel_path)
+            else:
+                info, data = future.result()
+                append_raw_entry(zipf, info, (data,))
+                del data
+            in_flight -= cost
+            fill()
             done += 1
             if done % max(1, total_files // 50) == 0 or done == total_files:
                 percent = (done / total_files) * 100
@@ -91,52 +572,123 @@ def zip_folder(folder_path, zip_path):
 def load_old_hash():
     if os.path.exists(HASH_RECORD_FILE):
         try:
-            with open(HASH_RECORD_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(HASH_RECORD_FILE, "rb") as f:
+                data = f.read()
+            return orjson.loads(data) if orjson is not None else json.loads(data)
         except Exception:
             return {}
     return {}
 
 def save_hash_record(record):
-    with open(HASH_RECORD_FILE, "w", encoding="utf-8") as f:
-        json.dump(record, f, ensure_ascii=False, indent=2)
+    """以精簡 JSON 寫入暫存檔後再取代，程式中途被中止也不會留下半個記錄檔"""
+    if orjson is not None:
+        data = orjson.dumps(record)
+    else:
+        data = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    tmp_path = HASH_RECORD_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, HASH_RECORD_FILE)
+
+def folder_digest(files_hash):
+    """由 {相對路徑: 雜湊} 算出整個資料夾的指紋，內容不變時 zip 的 ETag 也不變"""
+    h = hashlib.md5()
+    for rel_path in sorted(files_hash):
+        h.update(f"{rel_path}\0{files_hash[rel_path]}\n".encode("utf-8"))
+    return h.hexdigest()
+
+def encode_json(data):
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+def publish_hash_record(record):
+    """將掃描記錄轉成各資料夾 ?json 回應的 bytes，放進記憶體供請求直接取用"""
+    global hash_json_cache
+    encoded = {}
+    for key, files in record.items():
+        if key in (HASH_ALGO_KEY, ZIP_DIGEST_KEY):
+            continue
+        files_hash = hash_map(files)
+        encoded[(key, False)] = encode_json(files_hash)
+        encoded[(key, True)] = encode_json({"algo": HASH_ALGO, "digest": files_hash})
+    with hash_record_lock:
+        hash_json_cache = encoded
 
 def create_zip_cache():
-    """比對檔案變動，僅在有變動時重建快取"""
+    """掃描所有資料夾並更新雜湊記錄；zip 不在啟動時壓縮，而是第一次下載時於背景建立"""
+    global hash_record
     print("🗜️ 正在檢查 ZIP 快取...")
     old_hash = load_old_hash()
+    if old_hash.pop(HASH_ALGO_KEY, "md5") != HASH_ALGO:
+        print(f"🔁 雜湊演算法改為 {HASH_ALGO}，重新計算所有檔案")
+        old_hash = {}
+    # 舊版記錄沒有 zip 指紋：當時每次啟動都會重建 zip，視為與舊記錄一致
+    old_built = old_hash.pop(ZIP_DIGEST_KEY, None)
+    if old_built is None:
+        old_built = {key: folder_digest(hash_map(files)) for key, files in old_hash.items()}
     new_hash = {}
-    changed_keys = []
 
-    # 計算每個資料夾的 hash
-    for key, folder_path in folders.items():
-        new_hash[key] = scan_folder_dict(folder_path)
-        if key not in old_hash or new_hash[key] != old_hash[key]:
-            changed_keys.append(key)
+    # 計算每個資料夾的 hash（所有資料夾共用同一個執行緒池）
+    with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_WORKERS) as hash_executor:
+        for key, folder_path in folders.items():
+            new_hash[key] = scan_folder_dict(folder_path, old_hash.get(key), hash_executor)
 
-    if not changed_keys:
-        print("✅ 所有資料夾與快照相同，使用現有快取。")
-    else:
-        print(f"♻️ 偵測到變動的資料夾: {', '.join(changed_keys)}")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=min(4, len(changed_keys))) as executor:
-            futures = {executor.submit(zip_folder, folders[key], os.path.join(CACHE_DIR, f"{key}.zip")): key for key in changed_keys}
-            for future in concurrent.futures.as_completed(futures):
-                k = futures[future]
-                try:
-                    future.result()
-                    print(f"[快取更新完成] {k}")
-                except Exception as e:
-                    print(f"[快取失敗] {k}: {e}")
-
-    # 更新 cache_files 映射
+    stale_keys = []
     for key in folders:
+        files = hash_map(new_hash[key])
+        digest = folder_digest(files)
+        current_files[key] = files
+        zip_etags[key] = f'"{digest}"'
         cache_files[key] = os.path.join(CACHE_DIR, f"{key}.zip")
+        if key in old_built and os.path.exists(cache_files[key]):
+            zip_built_digest[key] = old_built[key]
+            if key in old_hash and old_built[key] == folder_digest(hash_map(old_hash[key])):
+                zip_base_files[key] = hash_map(old_hash[key])
+        if zip_built_digest.get(key) != digest:
+            stale_keys.append(key)
+
+    prune_blobs({h for files in current_files.values() for h in files.values()})
+
+    if not stale_keys:
+        print("✅ 所有資料夾與快照相同，使用現有快取。")
+    else:
+        print(f"♻️ 偵測到變動的資料夾（第一次下載時重建 zip）: {', '.join(stale_keys)}")
 
-    save_hash_record(new_hash)
+    new_hash[HASH_ALGO_KEY] = HASH_ALGO
+    new_hash[ZIP_DIGEST_KEY] = dict(zip_built_digest)
+    with hash_record_lock:
+        hash_record = new_hash
+        save_hash_record(new_hash)
+    publish_hash_record(new_hash)
     print("📦 快取初始化完成！")
 
 # -------------------- HTTP 處理 --------------------
+# 所有 HTML 頁面共用的外框，預先編碼好，每次只需串接內容
+HTML_HEAD = ("<html><head><meta charset='utf-8'><title>Server</title></head>"
+             "<body style='background-color:#f3ecfc;color:#2b1d40;font-family:sans-serif;padding:20px;'>").encode("utf-8")
+HTML_TAIL = b"</body></html>"
+
 class FileBrowserHandler(BaseHTTPRequestHandler):
+    def setup(self):
+        super().setup()
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if SOCKET_SNDBUF > 0:
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF)
+        except OSError:
+            pass
+
+    def _set_cork(self, enabled):
+        """Linux 的 TCP_CORK：暫存標頭，與檔案內容一起送出（其他平台不處理）"""
+        if hasattr(socket, "TCP_CORK"):
+            try:
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
+            except OSError:
+                pass
+
     def do_GET(self):
         url_parts = urlparse(self.path)
         path = unquote(url_parts.path)
@@ -164,7 +716,7 @@ class FileBrowserHandler(BaseHTTPRequestHandler):
 
         # ------------------- config_names -------------------
         if path.lstrip("/") == "config_names" and json_mode:
-            self._send_json(list(folders.keys()))
+            self._send_json_bytes(CONFIG_NAMES_JSON)
             return
 
         # ------------------- 其他資料夾 / 檔案 -------------------
@@ -183,19 +735,33 @@ class FileBrowserHandler(BaseHTTPRequestHandler):
                 return
             elif os.path.isdir(real_path):
                 if download_mode:
-                    zip_path = cache_files.get(parts[0])
-                    if zip_path and os.path.exists(zip_path):
-                        self._send_file(zip_path, True)
-                        return
+                    key = parts[0]
+                    if not sub_path and key in current_files:
+                        if "stream" in query:
+                            count_stream_request(key)
+                        elif zip_is_current(key):
+                            self._send_file(cache_files[key], True, zip_etags[key])
+                            return
+                        else:
+                            # 快取不是最新：這次先即時串流，不讓客戶端等待整包壓縮完成
+                            build_zip_in_background(key)
+                    # ?stream=1、子資料夾或快取尚未建好：即時壓縮並直接串流給客戶端
+                    self._send_zip_stream(real_path)
+                    return
                 elif json_mode:
-                    # 嘗試從快取讀取 MD5
-                    try:
-                        with open(HASH_RECORD_FILE, "r", encoding="utf-8") as f:
-                            hash_record = json.load(f)
-                        files_md5 = hash_record.get(parts[0], scan_folder_dict(real_path))
-                    except Exception:
-                        files_md5 = scan_folder_dict(real_path)
-                    self._send_json(files_md5)
+                    # 新版客戶端以 ?algo= 詢問演算法，回傳 {"algo", "digest"}
+                    with_algo = "algo" in query
+                    headers = {"X-Digest-Algo": HASH_ALGO} if with_algo else None
+                    body = hash_json_cache.get((parts[0], with_algo))
+                    if body is not None:
+                        self._send_json_bytes(body, headers)
+                        return
+                    # 記憶體中沒有記錄（尚未初始化完成）才即時掃描
+                    files_hash = hash_map(scan_folder_dict(real_path))
+                    if with_algo:
+                        self._send_json({"algo": HASH_ALGO, "digest": files_hash}, headers)
+                    else:
+                        self._send_json(files_hash)
                     return
                 else:
                     self.send_folder_listing(parts[0], real_path, sub_path)
@@ -233,65 +799,163 @@ class FileBrowserHandler(BaseHTTPRequestHandler):
         self._send_html(html)
 
     def send_folder_listing(self, key, folder_path, sub_path):
-        html = f"<h2 style='color:#4a2a8a;'>📁 Folder: /{key}"
-        if sub_path:
-            html += f"/{sub_path}"
-        html += "</h2><ul>"
-        for entry in os.listdir(folder_path):
-            if should_ignore(entry):
-                continue
-            entry_path = os.path.join(folder_path, entry)
-            entry_url = '/' + key + '/' + quote(sub_path + '/' + entry if sub_path else entry)
-            icon = "📂" if os.path.isdir(entry_path) else "📄"
-            html += f"<li>{icon} <a href='{entry_url}{'?download=1' if os.path.isfile(entry_path) else ''}'>{entry}</a></li>"
-        html += "</ul><hr><a href='/'>返回首頁</a> | "
-        html += f"<a href='/{key}?download=1'>下載整包 ZIP</a>"
-        self._send_html(html)
+        title = f"/{key}/{sub_path}" if sub_path else f"/{key}"
+        base_url = f"/{key}/" + (quote(sub_path) + "/" if sub_path else "")
+        parts = [f"<h2 style='color:#4a2a8a;'>📁 Folder: {title}</h2><ul>"]
+        with os.scandir(folder_path) as it:
+            for entry in it:
+                if should_ignore(entry.name):
+                    continue
+                entry_url = base_url + quote(entry.name)
+                if entry.is_dir():
+                    parts.append(f"<li>📂 <a href='{entry_url}'>{entry.name}</a></li>")
+                elif entry.is_file():
+                    parts.append(f"<li>📄 <a href='{entry_url}?download=1'>{entry.name}</a></li>")
+                else:
+                    parts.append(f"<li>📄 <a href='{entry_url}'>{entry.name}</a></li>")
+        parts.append(f"</ul><hr><a href='/'>返回首頁</a> | <a href='/{key}?download=1'>下載整包 ZIP</a>")
+        self._send_html("".join(parts))
 
     def send_homepage(self):
-        html = "<h2 style='color:#4a2a8a;'>📦 資料夾清單</h2><ul>"
+        parts = ["<h2 style='color:#4a2a8a;'>📦 資料夾清單</h2><ul>"]
         for key in folders:
-            html += f"<li>[DIR] <a href='/{key}'>{key}</a> " \
-                    f"<a href='/{key}?download=1' style='margin-left:10px;'>📥 下載整包</a></li>"
-        html += "</ul>"
-        self._send_html(html)
+            parts.append(f"<li>[DIR] <a href='/{key}'>{key}</a> "
+                         f"<a href='/{key}?download=1' style='margin-left:10px;'>📥 下載整包</a></li>")
+        parts.append("</ul>")
+        self._send_html("".join(parts))
 
     def _send_html(self, html):
-        full_html = f"<html><head><meta charset='utf-8'><title>Server</title></head>" \
-                    f"<body style='background-color:#f3ecfc;color:#2b1d40;font-family:sans-serif;padding:20px;'>{html}</body></html>"
+        body = HTML_HEAD + html.encode("utf-8") + HTML_TAIL
         self.send_response(200)
         self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(full_html.encode("utf-8"))
+        self.wfile.write(body)
+
+    def _send_json(self, data, headers=None):
+        self._send_json_bytes(encode_json(data), headers)
 
-    def _send_json(self, data):
+    def _send_json_bytes(self, body, headers=None):
         self.send_response(200)
         self.send_header("Content-Type", "application/json; charset=utf-8")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_zip_stream(self, folder_path):
+        """即時壓縮資料夾並串流輸出；長度事先未知，以關閉連線結束回應"""
+        zip_name = os.path.basename(folder_path.rstrip(os.sep)) + ".zip"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{urllib.parse.quote(zip_name)}")
+        self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
+        self.close_connection = True
+        # wfile 沒有緩衝且已開啟 TCP_NODELAY，先集中成大區塊再送出，避免每個標頭都成為一個小封包
+        out = io.BufferedWriter(SocketRawWriter(self.wfile), COPY_BUFSIZE)
+        try:
+            stream_zip(folder_path, out)
+            out.flush()
+        except ConnectionError:
+            print(f"[警告] 客戶端中斷下載: {zip_name}")
+        except OSError as e:
+            # zip 不完整：不送出剩餘緩衝，直接關閉連線，客戶端會因缺少中央目錄而解壓失敗
+            print(f"[錯誤] 串流壓縮失敗，已中斷下載: {zip_name}, {e}")
 
-    def _send_file(self, file_path, download=False):
+    def _not_modified(self, etag, mtime):
+        """依 If-None-Match / If-Modified-Since 判斷客戶端的版本是否仍是最新"""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return int(mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _send_file(self, file_path, download=False, etag=None):
+        """傳送檔案，支援 Range 續傳（206 Partial Content）與條件式 GET（304 Not Modified）
+
+        etag 未指定時以 mtime 與大小產生。
+        """
         if not os.path.exists(file_path):
             self.send_error(404, f"{file_path} not found")
             return
         file_name = os.path.basename(file_path)
-        self.send_response(200)
-        self.send_header("Content-Type", "application/octet-stream")
-        if download:
-            encoded = urllib.parse.quote(file_name)
-            self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{encoded}")
-        self.send_header("Content-Length", str(os.path.getsize(file_path)))
-        self.end_headers()
         try:
             with open(file_path, "rb") as f:
-                shutil.copyfileobj(f, self.wfile, 8192)
-        except ConnectionResetError:
+                advise_sequential(f)
+                st = os.fstat(f.fileno())
+                size = st.st_size
+                etag = etag or f'"{st.st_mtime_ns:x}-{size:x}"'
+                last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+                if self._not_modified(etag, st.st_mtime):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified", last_modified)
+                    self.end_headers()
+                    return
+                start, end = 0, size - 1
+                m = RANGE_RE.match(self.headers.get("Range", "").strip())
+                if m and (m.group(1) or m.group(2)):
+                    if m.group(1):
+                        start = int(m.group(1))
+                        if m.group(2):
+                            end = min(int(m.group(2)), size - 1)
+                    else:
+                        # bytes=-N：最後 N 個位元組
+                        start = max(0, size - int(m.group(2)))
+                    if start >= size or start > end:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{size}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                if download:
+                    encoded = urllib.parse.quote(file_name)
+                    self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{encoded}")
+                length = end - start + 1
+                self.send_header("Content-Length", str(length))
+                self._set_cork(True)
+                self.end_headers()
+
+                self.wfile.flush()
+                if length == 0:
+                    return  # 空檔案（socket.sendfile 不接受 count=0）
+                try:
+                    # 由核心直接從檔案送到 socket（Linux 為 sendfile 零拷貝，不支援時 socket 模組會自行改用 send）
+                    self.connection.sendfile(f, start, length)
+                except (AttributeError, io.UnsupportedOperation):
+                    f.seek(start)
+                    remaining = length
+                    while remaining > 0:
+                        chunk = f.read(min(COPY_BUFSIZE, remaining))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+        except (ConnectionResetError, BrokenPipeError):
             print(f"[警告] 客戶端中斷下載: {file_name}")
+        finally:
+            self._set_cork(False)
 
 # -------------------- 啟動 HTTP 服務 --------------------
 if __name__ == "__main__":
     print("\n🚀 伺服器啟動中: http://localhost:8000")
     create_zip_cache()
     server_address = ("", 8000)
-    httpd = HTTPServer(server_address, FileBrowserHandler)
+    httpd = ThreadingHTTPServer(server_address, FileBrowserHandler)  # 每個連線一個執行緒，大檔下載不會卡住其他請求
     httpd.serve_forever()